@@ -0,0 +1,14 @@
+"""Base64 helpers backed by pybase64's SIMD codec"""
+import pybase64
+
+def encode(data):
+    """Encode bytes or any buffer (memoryview, bytearray) to base64 bytes"""
+    return pybase64.b64encode(data)
+
+def encode_str(data):
+    """Encode bytes or any buffer to a base64 str"""
+    return pybase64.b64encode_as_string(data)
+
+def decode(data):
+    """Decode base64 str or bytes without strict alphabet validation"""
+    return pybase64.b64decode(data, validate=False)
@@ -1,45 +1,85 @@
 #!/usr/bin/env python3
 import os
-import base64
+import atexit
 import subprocess
-import tempfile
-import json
+import orjson
 from pathlib import Path
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 import pyaudio
 import wave
 import threading
 import io
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from PIL import Image, UnidentifiedImageError
+import b64
 from openai import OpenAI
 
 app = Flask(__name__)
 CORS(app)
 
+# Caps /upload_screenshot bodies; a 5K PNG is well under this
+app.config['MAX_CONTENT_LENGTH'] = 25 * 1024 * 1024
+
 api_key = os.getenv('OPENAI_API_KEY')
 if not api_key:
     raise ValueError("OPENAI_API_KEY environment variable not set")
 
-client = OpenAI(api_key=api_key)
+# One keep-alive HTTP/2 connection pool shared by every OpenAI call,
+# so requests reuse the TLS session instead of reconnecting
+http_client = httpx.Client(
+    http2=True,
+    timeout=60,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=300)
+)
+client = OpenAI(api_key=api_key, http_client=http_client)
+
+# GPT-4o scales images down to this size on the long side anyway
+SCREENSHOT_MAX_SIZE = 2048
+SCREENSHOT_JPEG_QUALITY = 85
+JPEG_DATA_URL_PREFIX = 'data:image/jpeg;base64,'
+# Image types GPT-4o vision accepts
+ALLOWED_SCREENSHOT_MIMETYPES = {'image/png', 'image/jpeg', 'image/webp', 'image/gif'}
+
+# 48 KiB of raw image per streamed screenshot chunk (multiple of 3 bytes)
+SCREENSHOT_CHUNK_SIZE = 48 * 1024
+
+# Keep caches and proxies from holding back streamed events
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
 
 class AudioRecorder:
     def __init__(self):
         self.is_recording = False
-        self.frames = []
         self.stream = None
-        self.audio = None
-        self.CHUNK = 1024
+        # PortAudio init probes every device, so do it once per process
+        self.audio = pyaudio.PyAudio()
+        atexit.register(self.audio.terminate)
+        self.CHUNK = 512
         self.FORMAT = pyaudio.paInt16
         self.CHANNELS = 1
-        self.RATE = 44100
+        self.RATE = 16000  # Whisper works at 16 kHz natively
+        self.MAX_SECONDS = 300
+
+        # Preallocated buffer for int16 samples, so the realtime callback
+        # only copies bytes instead of allocating Python objects
+        self._ring = bytearray(self.RATE * self.MAX_SECONDS * self.CHANNELS * 2)
+        self._write_pos = 0
+        # Set when MAX_SECONDS is reached and the stream is ended early
+        self.truncated = False
+        # Guards _write_pos between the PortAudio thread and request threads
+        self._lock = threading.Lock()
 
     def start_recording(self):
         if self.is_recording:
             return {"status": "already recording"}
 
-        self.frames = []
+        self.clear_buffer()
+        self.truncated = False
         self.is_recording = True
-        self.audio = pyaudio.PyAudio()
 
         try:
             self.stream = self.audio.open(
@@ -58,7 +98,16 @@ class AudioRecorder:
 
     def _audio_callback(self, in_data, frame_count, time_info, status):
         if self.is_recording:
-            self.frames.append(in_data)
+            with self._lock:
+                end = min(self._write_pos + len(in_data), len(self._ring))
+                self._ring[self._write_pos:end] = in_data[:end - self._write_pos]
+                self._write_pos = end
+                full = end == len(self._ring)
+
+            # Out of room: end the stream rather than silently drop audio
+            if full:
+                self.truncated = True
+                return (in_data, pyaudio.paComplete)
         return (in_data, pyaudio.paContinue)
 
     def stop_recording(self):
@@ -69,31 +118,181 @@ class AudioRecorder:
         if self.stream:
             self.stream.stop_stream()
             self.stream.close()
-        if self.audio:
-            self.audio.terminate()
 
-        return {"status": "recording stopped"}
+        # Logged here rather than in the realtime callback
+        if self.truncated:
+            print(f"Recording reached the {self.MAX_SECONDS}s limit and was truncated")
+
+        return {"status": "recording stopped", "truncated": self.truncated}
 
     def get_audio_data(self):
         """Get recorded audio as WAV bytes"""
-        if not self.frames:
+        # Copy under the lock: clear_buffer()/start_recording() on another
+        # request thread could otherwise let the callback overwrite the data
+        with self._lock:
+            pcm = bytes(memoryview(self._ring)[:self._write_pos])
+        if not pcm:
             return None
 
+        sample_width = self.audio.get_sample_size(self.FORMAT)
+
         wav_buffer = io.BytesIO()
         with wave.open(wav_buffer, 'wb') as wf:
             wf.setnchannels(self.CHANNELS)
-            wf.setsampwidth(self.audio.get_sample_size(self.FORMAT) if self.audio else 2)
+            wf.setsampwidth(sample_width)
             wf.setframerate(self.RATE)
-            wf.writeframes(b''.join(self.frames))
+            # Declaring the length up front lets wave write the header once
+            # instead of seeking back to patch it after the data
+            wf.setnframes(len(pcm) // (sample_width * self.CHANNELS))
+            wf.writeframes(pcm)
 
-        wav_buffer.seek(0)
         return wav_buffer.getvalue()
 
     def clear_buffer(self):
-        self.frames = []
+        with self._lock:
+            self._write_pos = 0
 
 recorder = AudioRecorder()
 
+class ScreenshotStore:
+    """Keeps recent screenshots in memory so clients can refer to them by id"""
+    def __init__(self, max_items=8):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, image_data, mimetype='image/jpeg'):
+        screenshot_id = uuid.uuid4().hex
+        with self._lock:
+            self._items[screenshot_id] = (image_data, mimetype)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return screenshot_id
+
+    def get(self, screenshot_id):
+        with self._lock:
+            return self._items.get(screenshot_id)
+
+screenshots = ScreenshotStore()
+
+def downscale_screenshot(image_data):
+    """Shrink a screenshot to fit SCREENSHOT_MAX_SIZE, re-encoding it as JPEG if needed"""
+    image = Image.open(io.BytesIO(image_data))
+    if max(image.size) <= SCREENSHOT_MAX_SIZE:
+        return image_data
+
+    image.thumbnail((SCREENSHOT_MAX_SIZE, SCREENSHOT_MAX_SIZE), Image.LANCZOS)
+    # JPEG has no alpha or palette modes (uploaded PNG/GIF)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=SCREENSHOT_JPEG_QUALITY)
+    return buffer.getvalue()
+
+# Runs independent OpenAI and screencapture calls side by side
+executor = ThreadPoolExecutor(max_workers=4)
+
+class ScreenshotError(Exception):
+    pass
+
+def transcribe_audio(audio_data):
+    """Transcribe WAV bytes with Whisper"""
+    # The OpenAI client only needs a file-like object with a name
+    audio_file = io.BytesIO(audio_data)
+    audio_file.name = 'audio.wav'
+
+    transcription = client.audio.transcriptions.create(
+        model="whisper-1",
+        file=audio_file
+    )
+    return transcription.text
+
+def take_screenshot():
+    """Capture the screen on macOS and return it as JPEG bytes"""
+    # -x: no sound, -T: no shadow, -t: type
+    # JPEG is far smaller than PNG and GPT-4o re-encodes images anyway.
+    # Write the image to stdout so it never touches the disk
+    result = subprocess.run(
+        ['screencapture', '-x', '-T0', '-t', 'jpg', '/dev/stdout'],
+        capture_output=True,
+        timeout=10
+    )
+
+    if result.returncode != 0:
+        error_msg = result.stderr.decode('utf-8', 'replace').strip() if result.stderr else "Unknown error"
+        print(f"Screenshot error - return code: {result.returncode}")
+        print(f"Screenshot error - stderr: {error_msg}")
+
+        # Provide helpful error message
+        if "could not create image" in error_msg.lower():
+            raise ScreenshotError(
+                "Screenshot failed: Please grant Screen Recording permission to Terminal in System Settings > Privacy & Security > Screen Recording"
+            )
+
+        raise ScreenshotError(f"Screenshot failed: {error_msg}")
+
+    if not result.stdout:
+        raise ScreenshotError("Screenshot was empty")
+
+    return downscale_screenshot(result.stdout)
+
+def build_api_messages(messages, screenshot_base64=None, screenshot_mimetype='image/jpeg'):
+    """Convert client messages to the OpenAI format, attaching the screenshot to the last one"""
+    # Built once up front; the base64 payload can be several MB
+    screenshot_url = None
+    if screenshot_base64:
+        if screenshot_mimetype == 'image/jpeg':
+            prefix = JPEG_DATA_URL_PREFIX
+        else:
+            prefix = 'data:' + screenshot_mimetype + ';base64,'
+        screenshot_url = prefix + screenshot_base64
+
+    api_messages = []
+    last = len(messages) - 1
+    for i, msg in enumerate(messages):
+        content = msg.get('content')
+        role = msg.get('role')
+
+        if screenshot_url and i == last:
+            api_messages.append({
+                "role": role,
+                "content": [
+                    {"type": "text", "text": content},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": screenshot_url
+                        }
+                    }
+                ]
+            })
+        else:
+            api_messages.append({
+                "role": role,
+                "content": content
+            })
+
+    return api_messages
+
+def stream_chat(api_messages):
+    """Stream the GPT-4o reply as server-sent events"""
+    try:
+        response = client.chat.completions.create(
+            model="gpt-4o",
+            messages=api_messages,
+            stream=True
+        )
+
+        for chunk in response:
+            content = chunk.choices[0].delta.content
+            if content:
+                yield b"data: " + orjson.dumps({'content': content}) + b"\n\n"
+
+        yield b"data: [DONE]\n\n"
+
+    except Exception as e:
+        yield b"data: " + orjson.dumps({'error': str(e)}) + b"\n\n"
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({"status": "ok"})
@@ -120,24 +319,11 @@ def process_audio():
         if not audio_data:
             return jsonify({"error": "No audio data"}), 400
 
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
-            temp_file.write(audio_data)
-            temp_path = temp_file.name
+        transcription = transcribe_audio(audio_data)
 
-        try:
-            with open(temp_path, 'rb') as audio_file:
-                transcription = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file
-                )
+        recorder.clear_buffer()
 
-            recorder.clear_buffer()
-
-            return jsonify({"transcription": transcription.text})
-
-        finally:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+        return jsonify({"transcription": transcription, "truncated": recorder.truncated})
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -147,103 +333,135 @@ def send_message():
     try:
         data = request.json
         messages = data.get('messages', [])
+        screenshot_id = data.get('screenshotId')
         screenshot_base64 = data.get('screenshotBase64')
+        screenshot_mimetype = 'image/jpeg'
 
         if not messages:
             return jsonify({"error": "No messages provided"}), 400
 
-        api_messages = []
-        for msg in messages:
-            content = msg.get('content')
-            role = msg.get('role')
-
-            if screenshot_base64 and msg == messages[-1]:
-                api_messages.append({
-                    "role": role,
-                    "content": [
-                        {"type": "text", "text": content},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{screenshot_base64}"
-                            }
-                        }
-                    ]
-                })
-            else:
-                api_messages.append({
-                    "role": role,
-                    "content": content
-                })
+        if screenshot_id:
+            screenshot = screenshots.get(screenshot_id)
+            if screenshot is None:
+                return jsonify({"error": "Unknown screenshot id"}), 400
+            screenshot_data, screenshot_mimetype = screenshot
+            screenshot_base64 = b64.encode_str(screenshot_data)
+
+        api_messages = build_api_messages(messages, screenshot_base64, screenshot_mimetype)
 
         # Use streaming and let frontend handle formatting
-        def generate():
-            try:
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=api_messages,
-                    stream=True
-                )
+        return Response(stream_chat(api_messages), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-                for chunk in response:
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        yield f"data: {json.dumps({'content': content})}\n\n"
+@app.route('/query', methods=['POST'])
+def query():
+    """Stop recording, then transcribe it and capture the screen in parallel"""
+    try:
+        data = request.get_json(silent=True) or {}
+        messages = data.get('messages', [])
+
+        recorder.stop_recording()
+        audio_data = recorder.get_audio_data()
+
+        if not audio_data:
+            return jsonify({"error": "No audio data"}), 400
 
-                yield "data: [DONE]\n\n"
+        # Whisper and screencapture don't depend on each other, so overlap them
+        transcription_future = executor.submit(transcribe_audio, audio_data)
+        screenshot_future = executor.submit(take_screenshot)
+        transcription = transcription_future.result()
+        screenshot_data = screenshot_future.result()
 
-            except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        recorder.clear_buffer()
 
-        return Response(generate(), mimetype='text/event-stream')
+        if not transcription.strip():
+            return jsonify({"error": "No speech detected"}), 400
 
+        screenshot_id = screenshots.add(screenshot_data)
+        messages = messages + [{"role": "user", "content": transcription}]
+        api_messages = build_api_messages(messages, b64.encode_str(screenshot_data))
+
+        # The first event tells the client what was heard and captured
+        def generate():
+            yield b"data: " + orjson.dumps({
+                'transcription': transcription,
+                'screenshot_id': screenshot_id,
+                'truncated': recorder.truncated
+            }) + b"\n\n"
+            yield from stream_chat(api_messages)
+
+        return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+    except subprocess.TimeoutExpired:
+        return jsonify({"error": "Screenshot command timed out"}), 500
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/capture_screenshot', methods=['POST'])
-def capture_screenshot():
-    """Capture screenshot on macOS"""
+@app.route('/upload_screenshot', methods=['POST'])
+def upload_screenshot():
+    """Accept an image as multipart/form-data (or base64 JSON) and return its id"""
     try:
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as temp_file:
-            temp_path = temp_file.name
+        image = request.files.get('file')
+        if image:
+            image_data = image.read()
+            mimetype = image.mimetype
+        else:
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict) or not data.get('screenshotBase64'):
+                return jsonify({"error": "No file provided"}), 400
+            if not isinstance(data['screenshotBase64'], str):
+                return jsonify({"error": "screenshotBase64 must be a string"}), 400
+            try:
+                image_data = b64.decode(data['screenshotBase64'])
+            except ValueError:
+                return jsonify({"error": "Invalid base64 data"}), 400
+            mimetype = data.get('mimetype', 'image/jpeg')
+
+        if not isinstance(mimetype, str) or mimetype not in ALLOWED_SCREENSHOT_MIMETYPES:
+            return jsonify({"error": f"Unsupported image type: {mimetype or 'none'}"}), 400
+
+        if not image_data:
+            return jsonify({"error": "Empty file"}), 400
 
         try:
-            # Try different screencapture options
-            # -x: no sound, -T: no shadow, -t: type
-            result = subprocess.run(
-                ['screencapture', '-x', '-T0', temp_path],
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
+            resized = downscale_screenshot(image_data)
+        except UnidentifiedImageError:
+            return jsonify({"error": "Invalid image data"}), 400
+        # A resized image has been re-encoded as JPEG
+        if resized is not image_data:
+            image_data, mimetype = resized, 'image/jpeg'
 
-            if result.returncode != 0:
-                error_msg = result.stderr.strip() if result.stderr else "Unknown error"
-                print(f"Screenshot error - return code: {result.returncode}")
-                print(f"Screenshot error - stderr: {error_msg}")
-                print(f"Screenshot error - stdout: {result.stdout}")
+        return jsonify({"screenshot_id": screenshots.add(image_data, mimetype)})
 
-                # Provide helpful error message
-                if "could not create image" in error_msg.lower():
-                    return jsonify({
-                        "error": "Screenshot failed: Please grant Screen Recording permission to Terminal in System Settings > Privacy & Security > Screen Recording"
-                    }), 500
+    except RequestEntityTooLarge:
+        return jsonify({"error": "Image too large"}), 413
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-                return jsonify({"error": f"Screenshot failed: {error_msg}"}), 500
+@app.route('/capture_screenshot', methods=['POST'])
+def capture_screenshot():
+    """Capture screenshot on macOS"""
+    try:
+        screenshot_data = take_screenshot()
+        screenshot_id = screenshots.add(screenshot_data)
 
-            # Check if file was created and has content
-            if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-                return jsonify({"error": "Screenshot file not created"}), 500
+        # Stream the image as base64 chunks so encoding overlaps with sending.
+        # The chunk size is a multiple of 3, so no chunk except the last one
+        # carries '=' padding and the client can simply concatenate them.
+        # The id comes first so the client can send it back instead of the image.
+        def generate():
+            yield b"data: " + orjson.dumps({'id': screenshot_id}) + b"\n\n"
 
-            with open(temp_path, 'rb') as f:
-                screenshot_data = f.read()
+            view = memoryview(screenshot_data)
+            for offset in range(0, len(view), SCREENSHOT_CHUNK_SIZE):
+                encoded = b64.encode(view[offset:offset + SCREENSHOT_CHUNK_SIZE])
+                yield b'data: {"chunk":"' + encoded + b'"}\n\n'
 
-            base64_data = base64.b64encode(screenshot_data).decode('utf-8')
-            return jsonify({"screenshot": base64_data})
+            yield b"data: [DONE]\n\n"
 
-        finally:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+        return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
 
     except subprocess.TimeoutExpired:
         return jsonify({"error": "Screenshot command timed out"}), 500
@@ -255,4 +473,5 @@ if __name__ == '__main__':
     print(f"Running on http://localhost:5001")
     print(f"Recording mode: Manual (toggle with Cmd+Enter)")
 
-    app.run(host='0.0.0.0', port=5001, debug=True, threaded=True)
+    # Development server only; production runs under gunicorn (see start-production.sh)
+    app.run(host='0.0.0.0', port=5001, debug=os.getenv('FLASK_DEBUG') == '1', threaded=True)
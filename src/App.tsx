@@ -70,6 +70,11 @@ function App() {
           return;
         }
 
+        // Backend stops capturing at its 5-minute buffer limit
+        if (data.truncated) {
+          setError('Recording hit the 5-minute limit and was truncated');
+        }
+
         // Add user message
         const userMessage: Message = {
           role: 'user',
@@ -192,17 +197,53 @@ function App() {
     return () => window.removeEventListener('keydown', handleKeyDown);
   }, [toggleVoiceRecording]);
 
-  const captureScreenshot = async (): Promise<string | null> => {
+  const captureScreenshot = async (): Promise<{ id: string; base64: string } | null> => {
     try {
       setError(null);
       const response = await fetch(`${API_URL}/capture_screenshot`, { method: 'POST' });
-      const data = await response.json();
 
       if (!response.ok) {
+        const data = await response.json();
         throw new Error(data.error || 'Failed to capture screenshot');
       }
 
-      return data.screenshot;
+      // Screenshot arrives as a stream of base64 chunks
+      const reader = response.body?.getReader();
+      const decoder = new TextDecoder();
+      const chunks: string[] = [];
+      let screenshotId = '';
+      let buffer = '';
+
+      if (reader) {
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+
+          buffer += decoder.decode(value, { stream: true });
+          const events = buffer.split('\n\n');
+          // Keep the trailing partial event for the next read
+          buffer = events.pop() || '';
+
+          for (const event of events) {
+            if (!event.startsWith('data: ')) continue;
+            const data = event.slice(6);
+            if (data === '[DONE]') break;
+
+            const parsed = JSON.parse(data);
+            if (parsed.error) {
+              throw new Error(parsed.error);
+            }
+            if (parsed.id) {
+              screenshotId = parsed.id;
+            } else {
+              chunks.push(parsed.chunk);
+            }
+          }
+        }
+      }
+
+      if (!screenshotId || !chunks.length) return null;
+      return { id: screenshotId, base64: chunks.join('') };
     } catch (err: any) {
       setError(`Screenshot failed: ${err.message}`);
       return null;
@@ -216,11 +257,11 @@ function App() {
     setError(null);
 
     try {
-      let screenshotBase64: string | null = null;
+      let screenshot: { id: string; base64: string } | null = null;
 
       if (withScreenshot) {
-        screenshotBase64 = await captureScreenshot();
-        if (!screenshotBase64) {
+        screenshot = await captureScreenshot();
+        if (!screenshot) {
           setIsLoading(false);
           return;
         }
@@ -230,7 +271,7 @@ function App() {
         role: 'user',
         content: input.trim() || 'Analyze this screenshot',
         timestamp: Date.now(),
-        screenshot: screenshotBase64 || undefined,
+        screenshot: screenshot?.base64,
       };
 
       const updatedMessages = [...messages, userMessage];
@@ -246,7 +287,8 @@ function App() {
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           messages: updatedMessages.map(m => ({ role: m.role, content: m.content })),
-          screenshotBase64
+          // Server already holds the image, so only its id is sent back
+          screenshotId: screenshot?.id ?? null
         }),
         signal: abortControllerRef.current.signal
       });
@@ -320,7 +320,7 @@ function MessageList({ messages }: MessageListProps) {
             {msg.screenshot && (
               <div className="message-screenshot">
                 <img
-                  src={`data:image/png;base64,${msg.screenshot}`}
+                  src={`data:image/jpeg;base64,${msg.screenshot}`}
                   alt="Screenshot"
                 />
               </div>
@@ -42,7 +42,8 @@ fi
 # Активируем виртуальное окружение и запускаем backend
 echo "Starting Python backend on http://localhost:5001..."
 source venv/bin/activate
-python3 backend/server.py > /tmp/phantom-backend.log 2>&1 &
+# Один воркер: состояние записи хранится в памяти процесса
+gunicorn -k gthread -w 1 --threads 8 --chdir backend server:app --bind 0.0.0.0:5001 > /tmp/phantom-backend.log 2>&1 &
 BACKEND_PID=$!
 
 # Сохраняем PID для последующей остановки